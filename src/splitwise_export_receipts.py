@@ -1,39 +1,78 @@
 import click
 import os
 import json
-import requests
-import pandas as pd
+import csv
+import functools
+import httpx
+import xlsxwriter
 from splitwise import Splitwise
 from splitwise.expense import Expense
-from typing import Optional, List, Dict
-import urllib.parse
+from splitwise.exception import SplitwiseException
+from typing import Optional, List, Tuple, Iterable, Iterator, Callable, Deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager, suppress
+import itertools
+import operator
 import datetime
+import time
 
 AUTH_FILE = os.path.expanduser("~/.splitwise_auth.json")
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+MAX_RECEIPT_BYTES = 25 * 1024 * 1024  # Receipts larger than this are skipped
+PROGRESS_STEP = 8  # Redraw progress bars every this many items rather than on every one
+RETRY_STATUSES = {429, 502, 503, 504}  # Receipt responses worth retrying
+MAX_RETRIES = 3
+
+# --- HTTP Client ---
+def make_client(max_connections: int = 32) -> httpx.Client:
+    """
+    Build an httpx Client that pools and reuses connections and speaks HTTP/2 where the
+    server supports it, so receipts hosted on the same server are multiplexed over a few
+    connections instead of each paying a new TCP+TLS handshake.
+    Failed connection attempts are retried; max_connections should be at least the
+    number of concurrent downloads.
+    """
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    transport = httpx.HTTPTransport(http2=True, retries=MAX_RETRIES, limits=limits)
+    return httpx.Client(transport=transport, timeout=20.0, follow_redirects=True)
 
 # --- Authentication ---
+@functools.lru_cache(maxsize=1)
+def _load_auth() -> Optional[Splitwise]:
+    """
+    Return an API client built from the credentials saved in ~/.splitwise_auth.json,
+    or None if there are none (or they are unusable).
+    Cached, so the file is only read once per process.
+    """
+    if not os.path.exists(AUTH_FILE):
+        return None
+    try:
+        with open(AUTH_FILE, 'rb') as f:
+            data = json.loads(f.read())
+        consumer_key = data["consumer_key"]
+        consumer_secret = data["consumer_secret"]
+        access_token = data["access_token"]
+        access_token_secret = data["access_token_secret"]
+        sObj = Splitwise(consumer_key, consumer_secret)
+        sObj.setAccessToken({
+            "oauth_token": access_token,
+            "oauth_token_secret": access_token_secret
+        })
+        return sObj
+    except (KeyError, json.JSONDecodeError):
+        print(f"Warning: {AUTH_FILE} is malformed or missing keys. Proceeding with interactive authentication.")
+        return None
+
 def authenticate() -> Splitwise:
     """
     Authenticate with Splitwise and return an API client object.
     Stores/reuses tokens in ~/.splitwise_auth.json.
     Guides user through app creation if needed.
     """
-    if os.path.exists(AUTH_FILE):
-        try:
-            with open(AUTH_FILE, 'r') as f:
-                data = json.load(f)
-            consumer_key = data["consumer_key"]
-            consumer_secret = data["consumer_secret"]
-            access_token = data["access_token"]
-            access_token_secret = data["access_token_secret"]
-            sObj = Splitwise(consumer_key, consumer_secret)
-            sObj.setAccessToken({
-                "oauth_token": access_token,
-                "oauth_token_secret": access_token_secret
-            })
-            return sObj
-        except (KeyError, json.JSONDecodeError):
-            print(f"Warning: {AUTH_FILE} is malformed or missing keys. Proceeding with interactive authentication.")
+    sObj = _load_auth()
+    if sObj is not None:
+        return sObj
 
     print("\n--- Splitwise API Authentication ---")
     print("To use this tool, you need to create a Splitwise app to get your API keys.")
@@ -60,18 +99,43 @@ def authenticate() -> Splitwise:
         }, f)
     # Restrict permissions to owner only (read/write)
     os.chmod(AUTH_FILE, 0o600)
+    # Drop the cached "no credentials" result now that they are saved
+    _load_auth.cache_clear()
     print(f"\nAuthentication successful! Credentials saved to {AUTH_FILE}\n")
     return sObj
 
 # --- Expense Fetching ---
-def fetch_expenses(client: Splitwise, group_id: Optional[int] = None, date_range: Optional[str] = None) -> List[Expense]:
+PAGE_WINDOW = 8  # Number of expense pages requested concurrently
+
+def _get_page(client: Splitwise, offset: int, limit: int, params: dict, retries: int = 4) -> List[Expense]:
     """
-    Fetch all expenses for the user, optionally filtered by group or date.
-    Handles pagination and returns a list of Expense objects.
+    Fetch a single page of expenses, backing off and retrying if Splitwise rate limits us (HTTP 429).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return client.getExpenses(offset=offset, limit=limit, **params)
+        except SplitwiseException as e:
+            status = e.http_status
+            # The SDK stores the status code wrapped in a 1-tuple
+            if isinstance(status, tuple):
+                status = status[0] if status else None
+            if status != 429 or attempt == retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+    return []
+
+def iter_expenses(client: Splitwise, group_id: Optional[int] = None, date_range: Optional[str] = None,
+                  limit: int = 50, updated_after: Optional[str] = None) -> Iterator[Expense]:
+    """
+    Lazily fetch all expenses for the user, optionally filtered by group or date.
+    Handles pagination and yields Expense objects page by page, so callers can
+    start working on the first page while later pages are still being fetched.
+    Pages are requested speculatively in parallel (see PAGE_WINDOW) and yielded in order.
+    limit is the requested page size; larger pages mean fewer round trips if the API accepts them.
+    updated_after (ISO date/datetime) restricts results to expenses changed since then, for incremental runs.
+    Filters are applied server-side, and are validated up front (before any expense is
+    requested) so that error messages don't interleave with the caller's progress output.
     """
-    expenses: List[Expense] = []
-    offset = 0
-    limit = 50  # Splitwise API max is 50 per call
     params = {}
     if group_id:
         params['group_id'] = group_id
@@ -85,101 +149,273 @@ def fetch_expenses(client: Splitwise, group_id: Optional[int] = None, date_range
             params['dated_before'] = end
         except Exception:
             print("Invalid date range format. Use YYYY-MM-DD:YYYY-MM-DD, and ensure both dates are valid ISO dates.")
-            return []
-    while True:
-        batch = client.getExpenses(offset=offset, limit=limit, **params)
-        if not batch:
-            break
-        expenses.extend(batch)
-        if len(batch) < limit:
-            break
-        offset += limit
-    print(f"Fetched {len(expenses)} expenses.")
-    return expenses
+            return iter(())
+    if updated_after:
+        try:
+            # datetime.fromisoformat only understands a trailing 'Z' from Python 3.11 on
+            datetime.datetime.fromisoformat(updated_after.replace('Z', '+00:00'))
+            params['updated_after'] = updated_after
+        except ValueError:
+            print("Invalid updated-after date. Use an ISO date or timestamp such as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ.")
+            return iter(())
+    return _iter_pages(client, params, limit)
+
+def _iter_pages(client: Splitwise, params: dict, limit: int) -> Iterator[Expense]:
+    """
+    Yield every expense matching params, page by page, in order.
+    """
+    offset = 0
+    batch = _get_page(client, offset, limit, params)
+    # The server may cap the page size below limit, so step through offsets by the
+    # size of the first page it actually returned
+    step = len(batch)
+    if 0 < step < limit:
+        # A short first page is either the only page or a capped one: probe the next
+        # offset once before requesting a whole window of pages
+        yield from batch
+        offset += step
+        batch = _get_page(client, offset, limit, params)
+    # Keep a window of pages in flight so pagination costs roughly one round trip
+    # per PAGE_WINDOW pages
+    with ThreadPoolExecutor(max_workers=PAGE_WINDOW) as pager:
+        pending: Deque[Future] = deque()
+        while batch:
+            if len(batch) < step:
+                # A page shorter than the server's page size is the last one
+                yield from batch
+                break
+            while len(pending) < PAGE_WINDOW:
+                offset += step
+                pending.append(pager.submit(_get_page, client, offset, limit, params))
+            yield from batch
+            batch = pending.popleft().result()
+        # Anything still queued lies past the end
+        for future in pending:
+            future.cancel()
 
 # --- Receipt Downloading ---
-def download_receipts(expenses: List[Expense], output_dir: str) -> Dict[int, str]:
+def receipt_url(exp: Expense) -> Optional[str]:
     """
-    Download all receipts for the given expenses to the output directory.
-    Returns a mapping from expense ID to local receipt path (if downloaded).
-    Shows a progress bar in the terminal.
+    Return the original receipt URL for an expense, or None if it has no receipt.
     """
-    os.makedirs(output_dir, exist_ok=True)
-    receipt_map: Dict[int, str] = {}
-    expenses_with_receipts = [exp for exp in expenses if getattr(getattr(exp, 'receipt', None), 'original', None)]
-    with click.progressbar(expenses_with_receipts, label="Downloading receipts", show_pos=True, show_percent=True) as bar:
-        for exp in bar:
-            receipt = getattr(exp, 'receipt', None)
-            if receipt and getattr(receipt, 'original', None):
-                url = receipt.original
-                # Parse the URL to get the path without query string
-                parsed_url = urllib.parse.urlparse(url)
-                path = parsed_url.path
-                ext = os.path.splitext(path)[-1] or '.jpg'
-                local_name = f"receipt_{exp.id}{ext}"
-                local_path = os.path.join(output_dir, local_name)
-                try:
-                    r = requests.get(url, timeout=20, stream=True)
-                    r.raise_for_status()
-                    with open(local_path, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    receipt_map[exp.id] = local_path
-                except Exception as e:
-                    print(f"Failed to download receipt for expense {exp.id}: {e}")
-    print(f"Downloaded {len(receipt_map)} receipts.")
-    return receipt_map
+    return getattr(getattr(exp, 'receipt', None), 'original', None)
+
+def _ext_of(url: str) -> str:
+    """
+    Return the file extension (with leading dot) of a receipt URL, ignoring any query string
+    or fragment. Falls back to '.jpg' if there is no sensible extension.
+    """
+    base = url.split('?', 1)[0].split('#', 1)[0].rsplit('/', 1)[-1]
+    _, dot, ext = base.rpartition('.')
+    return '.' + ext if dot and ext and len(ext) <= 5 and ext.isalnum() else '.jpg'
+
+def _cached_source(path: str) -> Optional[str]:
+    """
+    Return the receipt URL recorded in a .url sidecar file, or None if there is none.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def download_receipt(client: httpx.Client, exp_id: int, url: str, output_dir: str) -> str:
+    """
+    Download a single receipt into output_dir and return its local path.
+    A receipt already present from a previous run is reused instead of downloaded again,
+    unless the expense's receipt has been replaced since (its URL no longer matches).
+    Transient failures (RETRY_STATUSES) are retried with a short backoff.
+    Raises on HTTP or I/O errors, or if the receipt is larger than MAX_RECEIPT_BYTES.
+    """
+    local_name = f"receipt_{exp_id}{_ext_of(url)}"
+    local_path = os.path.join(output_dir, local_name)
+    # The source URL is saved next to each receipt; the query string is left out
+    # because signed receipt URLs get a fresh one every time they are fetched
+    source = url.split('?', 1)[0]
+    source_path = local_path + '.url'
+    # Reuse receipts downloaded by a previous run from the same URL
+    if os.path.exists(local_path) and os.path.getsize(local_path) > 0 and _cached_source(source_path) == source:
+        return local_path
+    # Write to a temporary file first so an interrupted download is never mistaken for a cached one
+    tmp_path = local_path + '.part'
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(0.3 * 2 ** (attempt - 1))
+        with client.stream("GET", url) as r:
+            if r.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                continue
+            r.raise_for_status()
+            # Headers arrive before the body, so oversized receipts are skipped without reading them
+            size = int(r.headers.get('Content-Length') or 0)
+            if size > MAX_RECEIPT_BYTES:
+                raise ValueError(f"receipt is {size} bytes, over the {MAX_RECEIPT_BYTES} byte limit")
+            # Count bytes as well, since chunked responses carry no Content-Length
+            received = 0
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in r.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > MAX_RECEIPT_BYTES:
+                            raise ValueError(f"receipt is over the {MAX_RECEIPT_BYTES} byte limit")
+                        f.write(chunk)
+            except BaseException:
+                # Don't leave a partial download behind
+                with suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+        os.replace(tmp_path, local_path)
+        with open(source_path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        return local_path
 
 # --- Spreadsheet Export ---
-def export_to_spreadsheet(expenses: List[Expense], receipt_map: Dict[int, str], output_file: str) -> None:
-    """
-    Export expenses and receipt links to a CSV/XLSX file.
-    For CSV: the 'Receipt' column contains a clickable HYPERLINK formula for local files (works in Excel/Google Sheets).
-    For XLSX: the 'Receipt' column contains the local file path as before.
-    """
-    rows = []
-    for exp in expenses:
-        receipt_path = receipt_map.get(exp.id, getattr(getattr(exp, 'receipt', None), 'original', ''))
-        # For CSV, use Excel/Sheets HYPERLINK formula if a local file exists
-        if output_file.lower().endswith('.csv') and receipt_path and os.path.exists(receipt_path):
-            # Use file:// prefix for local files
-            abs_path = os.path.abspath(receipt_path)
-            receipt_cell = f'=HYPERLINK("file://{abs_path}", "View Receipt")'
-            # Escape receipt_cell for CSV formula injection
-            if receipt_cell and receipt_cell[0] in ('=', '+', '-', '@'):
-                receipt_cell = "'" + receipt_cell
-        elif output_file.lower().endswith('.csv'):
-            receipt_cell = ''
-        else:
-            receipt_cell = receipt_path
-        row = {
-            'Expense ID': exp.id,
-            'Group ID': getattr(exp, 'group_id', None),
-            'Description': getattr(exp, 'description', ''),
-            'Details': '',  # No separate details field; leave blank or map to another attribute if needed
-            'Cost': getattr(exp, 'cost', ''),
-            'Currency': getattr(exp, 'currency_code', ''),
-            'Date': getattr(exp, 'date', ''),
-            'Deleted': getattr(exp, 'deleted_at', None) is not None,
-            'Deleted By': getattr(exp, 'deleted_by', None).getFirstName() if getattr(exp, 'deleted_by', None) else '',
-            'Notes': getattr(exp, 'details', ''),
-            'Receipt': receipt_cell,
-        }
-        rows.append(row)
-    df = pd.DataFrame(rows)
+COLUMNS = ['Expense ID', 'Group ID', 'Description', 'Details', 'Cost', 'Currency', 'Date', 'Deleted', 'Deleted By', 'Notes', 'Receipt']
+Row = Tuple[object, ...]  # One spreadsheet row, in COLUMNS order
+# Expense attributes used for each row, read in a single call (Expense objects built from API data set all of them)
+_EXPENSE_FIELDS = operator.attrgetter('id', 'group_id', 'description', 'cost', 'currency_code', 'date', 'deleted_at', 'deleted_by', 'details')
+
+def _expense_fields(exp: Expense) -> tuple:
+    """
+    Return (id, group_id, description, cost, currency_code, date, deleted_at, deleted_by, details) for an expense.
+    """
+    try:
+        return _EXPENSE_FIELDS(exp)
+    except AttributeError:
+        # Partially populated Expense: fall back to per-field defaults
+        return (exp.id, getattr(exp, 'group_id', None), getattr(exp, 'description', ''), getattr(exp, 'cost', ''),
+                getattr(exp, 'currency_code', ''), getattr(exp, 'date', ''), getattr(exp, 'deleted_at', None),
+                getattr(exp, 'deleted_by', None), getattr(exp, 'details', ''))
+
+# Excel/Sheets HYPERLINK formula to a local file, prefixed with ' to escape it against CSV formula injection
+_HYPERLINK = '\'=HYPERLINK("file://{}", "View Receipt")'.format
+
+def receipt_cell(local_path: Optional[str], url: str, for_csv: bool, cwd: str) -> str:
+    """
+    Return the 'Receipt' cell for an expense, given its downloaded receipt (if any) and receipt URL.
+    For CSV: a HYPERLINK formula to the downloaded file, or '' if it wasn't downloaded.
+    For XLSX: the local file path, falling back to the receipt URL.
+    cwd is the current directory, used to make relative paths absolute without a syscall per row.
+    """
+    if not for_csv:
+        return local_path or url
+    if not local_path:
+        return ''
+    return _HYPERLINK(local_path if os.path.isabs(local_path) else os.path.join(cwd, local_path))
+
+def build_row(exp: Expense, receipt: str) -> Row:
+    """
+    Build a single spreadsheet row for an expense, as a tuple in COLUMNS order.
+    receipt is the value of the 'Receipt' cell (see receipt_cell).
+    """
+    exp_id, group_id, description, cost, currency_code, date, deleted_at, deleted_by, details = _expense_fields(exp)
+    return (
+        exp_id,
+        group_id,
+        description,
+        '',  # Details: no separate details field; leave blank or map to another attribute if needed
+        cost,
+        currency_code,
+        date,
+        deleted_at is not None,
+        deleted_by.getFirstName() if deleted_by else '',
+        details,  # Notes
+        receipt,
+    )
+
+@contextmanager
+def open_spreadsheet(output_file: str) -> Iterator[Callable[[Row], None]]:
+    """
+    Open a CSV/XLSX file for writing (chosen by extension) and write the header row.
+    Yields a function that appends one row (in COLUMNS order); rows are streamed straight to disk,
+    so memory stays flat regardless of the number of expenses.
+    """
     if output_file.lower().endswith('.csv'):
-        df.to_csv(output_file, index=False)
+        with open(output_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            yield writer.writerow
     else:
-        df.to_excel(output_file, index=False)
-    print(f"Exported {len(rows)} expenses to {output_file}.")
+        # constant_memory makes xlsxwriter flush each row to disk as soon as it is written
+        workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'strings_to_urls': False})
+        try:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, COLUMNS)
+            row_numbers = itertools.count(1)
+
+            def write_row(row: Row) -> None:
+                worksheet.write_row(next(row_numbers), 0, row)
+
+            yield write_row
+        finally:
+            workbook.close()
+
+# --- Pipeline ---
+def run_pipeline(expenses: Iterable[Expense], output_file: str, output_dir: str, concurrency: int = 16) -> None:
+    """
+    Download receipts and export the spreadsheet in a single streaming pass.
+    Receipts are downloaded in parallel as expenses arrive; each expense's row is written
+    as soon as its receipt is ready (expenses without a receipt need no wait).
+    Rows keep the order of expenses.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for_csv = output_file.lower().endswith('.csv')
+    cwd = os.getcwd()
+    concurrency = max(1, concurrency)
+    # Expenses whose rows haven't been written yet, in order, with their receipt URL and download (if any)
+    pending: Deque[Tuple[Expense, str, Optional[Future]]] = deque()
+    counts = {'rows': 0, 'receipts': 0}
+
+    def next_row() -> Row:
+        # Write the oldest pending expense, waiting for its receipt download if needed
+        exp, url, future = pending.popleft()
+        local_path = None
+        if future is not None:
+            try:
+                local_path = future.result()
+                counts['receipts'] += 1
+            except Exception as e:
+                print(f"Failed to download receipt for expense {exp.id}: {e}")
+        counts['rows'] += 1
+        return build_row(exp, receipt_cell(local_path, url, for_csv, cwd))
+
+    def rows() -> Iterator[Row]:
+        # Bound how far downloads run ahead of the rows written, so there is never a large backlog of queued work
+        max_pending = concurrency * 2
+        with make_client(max_connections=max(32, concurrency)) as client:
+            ex = ThreadPoolExecutor(max_workers=concurrency)
+            try:
+                for exp in expenses:
+                    url = receipt_url(exp)
+                    future = ex.submit(download_receipt, client, exp.id, url, output_dir) if url else None
+                    pending.append((exp, url or '', future))
+                    while pending and (len(pending) > max_pending or pending[0][2] is None or pending[0][2].done()):
+                        yield next_row()
+                while pending:
+                    yield next_row()
+            except BaseException:
+                # On errors or Ctrl-C, drop queued downloads instead of waiting for them to run
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+            ex.shutdown()
+
+    with open_spreadsheet(output_file) as write_row:
+        with click.progressbar(rows(), label="Exporting expenses", show_pos=True, update_min_steps=PROGRESS_STEP) as bar:
+            for row in bar:
+                write_row(row)
+    print(f"Fetched {counts['rows']} expenses.")
+    print(f"Downloaded {counts['receipts']} receipts.")
+    print(f"Exported {counts['rows']} expenses to {output_file}.")
 
 @click.command()
 @click.option('--output', '-o', default=None, help='Output spreadsheet file (CSV or XLSX)')
 @click.option('--receipts-dir', default='receipts', help='Directory to save downloaded receipts')
 @click.option('--group', default=None, type=int, help='Group ID to filter expenses')
 @click.option('--date-range', default=None, help='Date range to filter expenses (e.g., 2023-01-01:2023-12-31)')
-def main(output: Optional[str], receipts_dir: str, group: Optional[int], date_range: Optional[str]):
+@click.option('--updated-after', default=None, help='Only export expenses created or changed since this ISO date or timestamp (e.g., 2024-06-01)')
+@click.option('--page-size', default=50, show_default=True, type=click.IntRange(min=1), help='Number of expenses to request per API call')
+@click.option('--concurrency', default=16, show_default=True, type=click.IntRange(min=1), help='Maximum number of receipts to download at once')
+def main(output: Optional[str], receipts_dir: str, group: Optional[int], date_range: Optional[str],
+         updated_after: Optional[str], page_size: int, concurrency: int):
     """
     Export all Splitwise transactions and receipts to a spreadsheet.
     Prompts for output file if not provided.
@@ -187,12 +423,11 @@ def main(output: Optional[str], receipts_dir: str, group: Optional[int], date_ra
     client = authenticate()
     user = client.getCurrentUser()
     print(f"Authenticated as: {user.getFirstName()} {user.getLastName()} ({user.getEmail()})\n")
-    expenses = fetch_expenses(client, group_id=group, date_range=date_range)
-    receipt_map = download_receipts(expenses, receipts_dir)
     # Prompt for output file if not provided
     if not output:
         output = click.prompt("Enter output file path (CSV or XLSX)", default="splitwise_export.csv")
-    export_to_spreadsheet(expenses, receipt_map, output)
+    expenses = iter_expenses(client, group_id=group, date_range=date_range, limit=page_size, updated_after=updated_after)
+    run_pipeline(expenses, output, receipts_dir, concurrency=concurrency)
     print(f"\nAll done! You can now open your exported file: {output}")
     print(f"Receipts (if any) are saved in: {os.path.abspath(receipts_dir)}")
 